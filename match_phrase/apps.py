@@ -1,5 +1,20 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class MatchPhraseConfig(AppConfig):
     name = 'match_phrase'
+
+    # load everything the views need when the server starts rather than on
+    # the first request: importing the views builds the ontology categorizer
+    # and loads the NLTK tokenizer and tagger, and one throwaway noun
+    # extraction runs them once
+    def ready(self):
+        from . import views
+        views.extract_nouns('warm up')
+
+        # optionally read all of WordNet into memory in the background
+        if getattr(settings, 'WORDNET_PRELOAD', False):
+            threading.Thread(target=views.oc.preload_wordnet, daemon=True).start()
@@ -9,7 +9,10 @@ Description: This module contains the classes and function definitions for
             be broken down into component concepts, as necessary.
 """
 
-import pandas as pd
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+import threading
 import nltk
 #nltk.download('wordnet')
 #nltk.download('brown')
@@ -17,6 +20,55 @@ import nltk
 #nltk.download('averaged_perceptron_tagger')
 from nltk.corpus import wordnet
 
+# the WordNet corpus reader seeks and reads shared file handles, so
+# lookups from concurrent threads are serialized
+_wordnet_lock = threading.RLock()
+
+# look up the WordNet synsets of a term; WordNet is static, so every lookup
+# is cached for the lifetime of the process (returned as a tuple so that the
+# shared cached value cannot be modified by callers)
+@lru_cache(maxsize=None)
+def synsets(term):
+    with _wordnet_lock:
+        return tuple(wordnet.synsets(term))
+
+# number of synsets read per lock section while preloading WordNet
+PRELOAD_CHUNK = 500
+
+# read every synset of WordNet once so that later lookups do not wait on disk
+# reads; the lock is only held while reading PRELOAD_CHUNK synsets at a time,
+# so lookups from requests are served in between
+def preload_wordnet():
+    with _wordnet_lock:
+        wordnet.ensure_loaded()
+    for pos in ['n', 'v', 'a', 'r']:
+        all_synsets = wordnet.all_synsets(pos)
+        chunk = True
+        while chunk:
+            with _wordnet_lock:
+                chunk = list(islice(all_synsets, PRELOAD_CHUNK))
+
+# return the (pos, definition) of a synset, cached per synset
+@lru_cache(maxsize=None)
+def synset_meta(ss):
+    return ss.pos(), ss.definition()
+
+# determine all of the synsets along all hypernym paths of a synset (including
+# the synset itself) in breadth-first order; the hypernym graph is a DAG, so
+# shared ancestors are visited only once, and the result is cached per synset
+@lru_cache(maxsize=None)
+def hypernym_closure(ss):
+    closure = [ss]
+    seen = {ss}
+    queue = deque(closure)
+    with _wordnet_lock:
+        while queue:
+            for h in queue.popleft().hypernyms():
+                if h not in seen:
+                    seen.add(h)
+                    closure.append(h)
+                    queue.append(h)
+    return tuple(closure)
 
 # An ontology category is the building block of the ontology categorizer.
 # It consists of
@@ -50,8 +102,17 @@ class OntologyCategory:
         if self.name == 'attribute':
             self.adj = True
 
-        # initialize a set of synsets mapped to the category
-        self.synsets = set()
+        # initialize the synsets mapped to the category as parallel lists of
+        # term names, WordNet indices and synsets, along with a lookup of the
+        # term.index labels of each synset and a set of just the root synsets
+        # for fast matching; version is bumped on every change so that
+        # indexes built from the category can tell when they are stale
+        self.version = 0
+        self._names = []
+        self._indices = []
+        self._synsets = []
+        self._labels_of = {}
+        self.synset_set = set()
         if not synset_list is None:
             # unpack dict input to list as necessary
             # if not list or dict, trigger an error
@@ -73,52 +134,72 @@ class OntologyCategory:
                 except:
                     print('Invalid synset contents.')
 
+    # rebuild the label lookup and set of root synsets after a synset is removed
+    def _reindex_synsets(self):
+        self._labels_of = {}
+        for name, index, ss in zip(self._names, self._indices, self._synsets):
+            self._labels_of.setdefault(ss, []).append(name+'.'+str(index))
+        self.synset_set = set(self._labels_of)
+
     # add a synset to the category by term name and WordNet index
     def add_synset(self, term, index):
         try:
-            self.synsets.add((term, index, wordnet.synsets(term)[index]))
+            ss = synsets(term)[index]
         except:
             print('Error: could not find syset {} for {}.'.format(index, term))
+            return
+        # a term and index always resolve to the same synset, so the entry
+        # is already present if its label is among the labels of the synset
+        label = term+'.'+str(index)
+        labels = self._labels_of.setdefault(ss, [])
+        if not label in labels:
+            self._names.append(term)
+            self._indices.append(index)
+            self._synsets.append(ss)
+            labels.append(label)
+            self.synset_set.add(ss)
+            self.version += 1
 
     # remove a synset category by term name and WordNet index
     def remove_synset(self, term, index):
-        rem = [r for r in self.synsets if (r[0]==term) and (r[1]==index)]
+        rem = [i for i, r in enumerate(zip(self._names, self._indices)) if r==(term, index)]
         if len(rem) > 0:
-            self.synsets.discard(rem[0])
+            del self._names[rem[0]]
+            del self._indices[rem[0]]
+            del self._synsets[rem[0]]
+            self._reindex_synsets()
+            self.version += 1
         else:
             print('Error: could not remove synset {} for {} because entry not in OntologyCategory.'\
             .format(index, term))
 
     # print definitions of all synset nodes in the ontology category
     def print_defs(self):
-        for name, index, ss in self.synsets:
+        for name, ss in zip(self._names, self._synsets):
             print(name, '\t' if len(name)>6 else '\t\t', \
                   ss.definition())
 
     # determine if a given term has hypernymy in this category (is subclass of)
     def is_hypernym_of(self,hypernym_tree):
-        # helper function that returns true when term is a Verb
-        def is_verb(term):
-            return term.pos()=='v'
-        # helper function that returns true when term is an Adjective
-        def is_adj(term):
-            return (term.pos()=='a') or (term.pos()=='s')
-
-        # step through the synsets in the hypernym tree
+
+        # find the root synsets that occur in the hypernym tree, and add
+        # them to the list of subtrees in tree order, once each
+        hits = self.synset_set.intersection(hypernym_tree)
         hyp = []
         for ss in hypernym_tree:
-            # if the synset matches, add it to the list of subtrees
-            for name, index, sss in self.synsets:
-                if ss == sss:
-                    hyp.append(name+'.'+str(index))
-            # if synset is a verb, and verb identifies category, then add
-            if self.verb:
-                if is_verb(ss):
-                    hyp.append('verb')
+            if ss in hits:
+                hits.discard(ss)
+                hyp.extend(self._labels_of[ss])
+        # if synset is a verb, and verb identifies category, then add; the
+        # synsets of a hypernym tree share the pos of the term itself, which
+        # is the first synset of the tree
+        if (self.verb or self.adj) and len(hypernym_tree) > 0:
+            pos = synset_meta(hypernym_tree[0])[0]
+            if self.verb and pos == 'v':
+                hyp.append('verb')
             # if synset is adjective and adj identifies category, then add
-            if self.adj:
-                if is_adj(ss):
-                    hyp.append('adjective')
+            if self.adj and pos in ('a', 's'):
+                hyp.append('adjective')
         # if at least one element found, add name of the category to result
         if hyp != []:
             hyp.append(self.name)
@@ -136,24 +217,29 @@ class OntologyCategorizer():
         else:
             self.name = name
 
-        # add categories if any are passed to constructor
+        # add categories if any are passed to constructor; categories are
+        # kept in order in a list and indexed by name in a dict
         self.categories = []
+        self._by_name = {}
+        # combined index of the root synsets of all categories, along with
+        # the category versions it was built from (see _synset_index)
+        self._index = (None, {})
         if not categories is None and isinstance(categories,list):
             for cat in categories:
                 self.add_category(cat)
 
     # add a category
     def add_category(self, cat):
-        self.categories.append(OntologyCategory(cat[0],cat[1]))
+        category = OntologyCategory(cat[0],cat[1])
+        self.categories.append(category)
+        self._by_name[category.name] = category
 
     # return a category
     def get_category(self, cat):
-        category = [c for c in self.categories if c.name==cat]
-        if len(category)==0:
+        category = self._by_name.get(cat, None)
+        if category is None:
             print('Error: Category {} not found.'.format(cat))
             category = ''
-        else:
-            category = category[0]
         return category
 
     # return list of category names
@@ -162,36 +248,58 @@ class OntologyCategorizer():
 
     # remove a scategory by name
     def remove_category(self, name):
-        rem = [r for r in self.categories if r.name==name]
-        if len(rem) > 0:
-            self.categories.discard(rem[0])
+        rem = self._by_name.pop(name, None)
+        if rem is not None:
+            self.categories.remove(rem)
         else:
             print('Error: could not remove {} because category not present.'.format(name))
 
+    # return an index from every root synset of the categories to the
+    # (category, term.index labels) pairs it belongs to, in category order;
+    # the index is rebuilt lazily whenever a category is added, removed or
+    # has its synsets changed
+    def _synset_index(self):
+        versions, index = self._index
+        current = [(c, c.version) for c in self.categories]
+        if versions != current:
+            index = {}
+            for c in self.categories:
+                for ss, labels in c._labels_of.items():
+                    index.setdefault(ss, []).append((c, labels))
+            self._index = (current, index)
+        return index
+
     # categorize a term
     def categorize_term(self, term, cat = None):
 
-        # helper function that unpacks a hypernym tree and extracts
-        # all of the synsets along all hypernym paths
-        def det_hypernym(tree):
-            elements = []
-            for h in tree:
-                if isinstance(h, list):
-                    elements.extend(det_hypernym(h))
-                else:
-                    elements.append(h)
-            return elements
-
-        # get hypernym tree for the desired term
-        hyp = []
-        hyp_tree = det_hypernym(term.tree(lambda s:s.hypernyms()))
+        # get all hypernyms of the desired term
+        hyp_tree = hypernym_closure(term)
 
-        # if no category selected, look up all categories
-        if cat is None:
-            for cat in self.categories:
-                hyp.extend(cat.is_hypernym_of(hyp_tree))
-        else:
-            hyp.extend(cat.is_hypernym_of(hyp_tree))
+        # if a category is selected, match it on its own
+        if not cat is None:
+            return cat.is_hypernym_of(hyp_tree)
+
+        # otherwise walk the hypernym tree once, collecting the subtrees of
+        # all categories in tree order
+        index = self._synset_index()
+        found = {}
+        for ss in hyp_tree:
+            for c, labels in index.get(ss, ()):
+                found.setdefault(c, []).extend(labels)
+
+        # add verbs and adjectives by the pos of the term, and the name of
+        # every category with at least one element found
+        pos = synset_meta(term)[0]
+        hyp = []
+        for c in self.categories:
+            h = found.get(c, [])
+            if c.verb and pos == 'v':
+                h.append('verb')
+            if c.adj and pos in ('a', 's'):
+                h.append('adjective')
+            if h != []:
+                hyp.extend(h)
+                hyp.append(c.name)
         return hyp
 
     # return true/false depending on whether a term belongs to a selected category
@@ -200,46 +308,60 @@ class OntologyCategorizer():
         return self.categorize_term(term, cat)!=[]
 
     # Determine what categories a given terms' word senses belong to in the ontology
-    #   oc. Returns a pandas DataFrame object consisting of word senses along with
-    #   categories and source synset(s) for each category.
+    #   oc. Returns a list of dicts, one per word sense, along with categories and
+    #   source synset(s) for each category (see to_dataframe for tabular output).
     def what_is(self, term):
 
-        term_cat = pd.DataFrame()
-        term_ss = wordnet.synsets(term)
-        loc = 0
+        rows = []
+        labels = []
         # loop through all of the synsets representing the term
-        for ss in term_ss:
-            index = len(term_cat)
-            term_cat.loc[index,'term']=term
-            term_cat.loc[index,'wordnet_ss_index']=loc
-            term_cat.loc[index,'definition']=ss.definition()
-            term_cat.loc[index,'pos']=ss.pos()
-            hyp = self.categorize_term(ss)
-            for h in hyp:
-                term_cat.loc[index,h]='yes'
-            loc += 1
-        return term_cat.fillna('no')
-
-    # Determine whether the word senses of a term belong to a given category
+        for loc, ss in enumerate(synsets(term)):
+            pos, definition = synset_meta(ss)
+            row = {'term':term, 'wordnet_ss_index':loc, \
+                   'definition':definition, 'pos':pos}
+            for h in self.categorize_term(ss):
+                row[h] = 'yes'
+                if not h in labels:
+                    labels.append(h)
+            rows.append(row)
+        # mark categories and subtrees that a word sense does not fall under
+        for row in rows:
+            for h in labels:
+                row.setdefault(h, 'no')
+        return rows
+
+    # return true as soon as one of the word senses of a term belongs to a
+    # given category
+    def is_cat_any(self, term, cat):
+        for ss in synsets(term):
+            if self.iscat_ss(ss,cat):
+                return True
+        return False
+
+    # return the WordNet indices of the word senses of a term that belong to a
+    # given category
+    def matching_indices(self, term, cat):
+        return [loc for loc, ss in enumerate(synsets(term)) if self.iscat_ss(ss,cat)]
+
+    # Determine whether the word senses of a term belong to a given category;
+    #   returns a list of dicts, one per word sense, or a Boolean if out is not 'long'
     def is_cat(self, term, cat, out = 'long'):
 
-        term_cat = pd.DataFrame()
-        term_ss = wordnet.synsets(term)
-        loc = 0
-        for ss in term_ss:
-            index = len(term_cat)
-            term_cat.loc[index,'term']=term
-            term_cat.loc[index,'wordnet_ss_index']=loc
-            term_cat.loc[index,'definition']=ss.definition()
-            term_cat.loc[index,'pos']=ss.pos()
-            term_cat.loc[index,cat]= 'yes' if self.iscat_ss(ss,cat) else 'no'
-            loc += 1
-        if out == 'long':
-            return term_cat
-        elif term_cat.empty:
-            return False
-        else:
-            return (term_cat[cat]=='yes').any()
+        if out != 'long':
+            return self.is_cat_any(term, cat)
+
+        rows = []
+        for loc, ss in enumerate(synsets(term)):
+            pos, definition = synset_meta(ss)
+            rows.append({'term':term, 'wordnet_ss_index':loc, \
+                         'definition':definition, 'pos':pos, \
+                         cat:'yes' if self.iscat_ss(ss,cat) else 'no'})
+        return rows
+
+# Convert the word sense rows returned by what_is or is_cat to a pandas DataFrame
+def to_dataframe(rows):
+    import pandas as pd
+    return pd.DataFrame(rows)
 
 # Initialize the Scientific Variabes Ontology categorizer
 #       return: object of class OntologyCategorizer
@@ -265,7 +387,7 @@ if __name__ == "__main__":
     import sys
     svo = init_svo()
     if len(sys.argv) == 2:
-        whatis = svo.what_is(sys.argv[1])
+        whatis = to_dataframe(svo.what_is(sys.argv[1]))
         print(sys.argv[1]+' has the following categories:')
         found = False
         cols = whatis.columns.values
@@ -286,7 +408,7 @@ if __name__ == "__main__":
         if not found:
             print('\tnone')
     elif len(sys.argv) == 3:
-        iscat = svo.is_cat(sys.argv[1],sys.argv[2])
+        iscat = to_dataframe(svo.is_cat(sys.argv[1],sys.argv[2]))
         print('The following definitions of '+sys.argv[1]+' are '+sys.argv[2]+':')
         found = False
         for _, row in iscat.iterrows():
@@ -1,3 +1,241 @@
+import json
+import threading
+import time
+from unittest import mock
+
 from django.test import TestCase
 
-# Create your tests here.
+from . import ontology_category as oc
+from . import views
+
+
+# a minimal stand-in for a WordNet synset, so that categorization can be
+# tested without the WordNet corpus
+class FakeSynset:
+    def __init__(self, name, pos = 'n', hypernyms = None):
+        self.name = name
+        self._pos = pos
+        self._hypernyms = hypernyms or []
+
+    def pos(self):
+        return self._pos
+
+    def definition(self):
+        return 'definition of ' + self.name
+
+    def hypernyms(self):
+        return self._hypernyms
+
+    def __repr__(self):
+        return 'FakeSynset({})'.format(self.name)
+
+
+class OntologyCategorizerTests(TestCase):
+
+    def setUp(self):
+        # a tiny WordNet: water -> liquid -> matter, and condition
+        self.matter = FakeSynset('matter')
+        self.liquid = FakeSynset('liquid', hypernyms = [self.matter])
+        self.water = FakeSynset('water', hypernyms = [self.liquid])
+        self.condition = FakeSynset('condition')
+        self.lexicon = {'matter':(self.matter,), 'liquid':(self.liquid,), \
+                        'water':(self.water,), 'condition':(self.condition,)}
+        patcher = mock.patch.object(oc, 'synsets', lambda term: self.lexicon.get(term, ()))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.categorizer = oc.OntologyCategorizer('test', \
+            [['phenomenon', {'matter':[0]}], ['state', {'condition':[0]}], \
+             ['process', {}], ['attribute', {}]])
+
+    def test_categorize_term(self):
+        self.assertEqual(self.categorizer.categorize_term(self.water), \
+                         ['matter.0', 'phenomenon'])
+        self.assertTrue(self.categorizer.iscat_ss(self.water, 'phenomenon'))
+        self.assertFalse(self.categorizer.iscat_ss(self.water, 'state'))
+
+    def test_verbs_and_adjectives_are_categorized_by_pos(self):
+        flow = FakeSynset('flow', pos = 'v', hypernyms = [FakeSynset('move', pos = 'v')])
+        self.assertEqual(self.categorizer.categorize_term(flow), ['verb', 'process'])
+        wet = FakeSynset('wet', pos = 's')
+        self.assertEqual(self.categorizer.categorize_term(wet), ['adjective', 'attribute'])
+
+    def test_pos_is_taken_from_the_term_synset(self):
+        category = oc.OntologyCategory('process', {})
+        tree = [self.water, FakeSynset('move', pos = 'v')]
+        self.assertEqual(category.is_hypernym_of(tree), [])
+
+    def test_synset_added_to_category_is_matched(self):
+        self.categorizer.get_category('state').add_synset('water', 0)
+        self.assertTrue(self.categorizer.iscat_ss(self.water, 'state'))
+
+    def test_synset_removed_from_category_is_not_matched(self):
+        self.categorizer.get_category('phenomenon').remove_synset('matter', 0)
+        self.assertFalse(self.categorizer.iscat_ss(self.water, 'phenomenon'))
+
+    def test_categorize_term_with_unregistered_category(self):
+        category = oc.OntologyCategory('foo', {'water':[0]})
+        self.assertEqual(self.categorizer.categorize_term(self.water, category), \
+                         ['water.0', 'foo'])
+
+    def test_is_hypernym_of_in_tree_order(self):
+        category = oc.OntologyCategory('foo', [('matter', [0]), ('water', [0])])
+        tree = [self.water, self.liquid, self.matter, self.water]
+        self.assertEqual(category.is_hypernym_of(tree), ['water.0', 'matter.0', 'foo'])
+
+    def test_added_category_is_matched(self):
+        self.assertEqual(self.categorizer.categorize_term(self.water), \
+                         ['matter.0', 'phenomenon'])
+        self.categorizer.add_category(['fluid', {'liquid':[0]}])
+        self.assertEqual(self.categorizer.categorize_term(self.water), \
+                         ['matter.0', 'phenomenon', 'liquid.0', 'fluid'])
+
+    def test_all_categories_match_each_category_on_its_own(self):
+        self.categorizer.get_category('state').add_synset('liquid', 0)
+        for term in [self.water, self.liquid, self.condition]:
+            single = []
+            for c in self.categorizer.categories:
+                single.extend(self.categorizer.categorize_term(term, c))
+            self.assertEqual(self.categorizer.categorize_term(term), single)
+
+    def test_remove_category(self):
+        self.categorizer.remove_category('state')
+        self.assertEqual(self.categorizer.get_categories(), ['phenomenon', 'process', 'attribute'])
+        self.assertEqual(self.categorizer.get_category('state'), '')
+        self.assertEqual(self.categorizer.categorize_term(self.condition), [])
+
+
+class RankMatchesTests(TestCase):
+
+    def test_matches_do_not_leak_between_calls(self):
+        water = ['water', [{'term':'water', 'classes':('Phenomenon',), \
+                            'variables':(('water_depth', 'water depth'),)}]]
+        soil = ['soil', [{'term':'soil', 'classes':(), \
+                          'variables':(('soil_mass', 'soil mass'),)}]]
+        first = views.rank_matches(water)
+        self.assertEqual(views.rank_matches(water), first)
+        self.assertEqual([r['IRI'] for r in views.rank_matches(soil)], ['soil_mass'])
+
+
+class InputValidationTests(TestCase):
+
+    def test_valid_input(self):
+        self.assertTrue(views._VALID_INPUT.match('depth_of_water'))
+
+    def test_trailing_newline_is_rejected(self):
+        self.assertIsNone(views._VALID_INPUT.match('water\n'))
+
+
+class OntologyQueryTests(TestCase):
+
+    # mock the SPARQL endpoint to return the given result bindings
+    def mock_endpoint(self, bindings):
+        resp = mock.Mock(content=json.dumps({'results':{'bindings':bindings}}).encode())
+        patcher = mock.patch.object(views._session, 'get', return_value=resp)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_query_classes(self):
+        get = self.mock_endpoint([
+            {'term':{'value':'water'}, 'class':{'value':'http://x#Phenomenon'}},
+            {'term':{'value':'water'}, 'class':{'value':'http://x#Phenomenon'}},
+            {'term':{'value':'water'}, 'class':{'value':'http://x#Matter'}}])
+        result = views.query_classes(['water', 'a"b'])
+        self.assertEqual(result, {'water':('Phenomenon', 'Matter'), 'a"b':()})
+        query = get.call_args[1]['params']['query']
+        self.assertIn('VALUES ?term { "water" "a\\"b" }', query)
+        self.assertIn('FILTER (str(?label) = ?term)', query)
+        self.assertEqual(get.call_args[1]['timeout'], views.SPARQL_TIMEOUT)
+
+    def test_query_variables(self):
+        get = self.mock_endpoint([
+            {'term':{'value':'water'}, 'variable':{'value':'http://x#water_depth'}, \
+             'varlabel':{'value':'water depth'}},
+            {'term':{'value':'water'}, 'variable':{'value':'http://x#water_depth'}, \
+             'varlabel':{'value':'water depth'}},
+            {'term':{'value':'soil'}, 'variable':{'value':'http://x#soil_mass'}, \
+             'varlabel':{'value':'soil mass'}}])
+        result = views.query_variables(['water', 'soil', 'ice'])
+        self.assertEqual(result, {'water':(('water_depth', 'water depth'),), \
+                                  'soil':(('soil_mass', 'soil mass'),), 'ice':()})
+        query = get.call_args[1]['params']['query']
+        self.assertIn('VALUES ?term { "water" "soil" "ice" }', query)
+
+    def test_cached_lookup_evicts_least_recently_used(self):
+        cache = views.OrderedDict()
+        lookup = mock.Mock(side_effect = lambda terms: {t:(t,) for t in terms})
+        with mock.patch.object(views, 'CACHE_SIZE', 2):
+            views.cached_lookup(cache, lookup, ['water', 'soil'])
+            views.cached_lookup(cache, lookup, ['water'])
+            self.assertEqual(views.cached_lookup(cache, lookup, ['ice', 'water']), \
+                             {'ice':('ice',), 'water':('water',)})
+        self.assertEqual(list(cache), ['water', 'ice'])
+        self.assertEqual(lookup.call_args_list, \
+                         [mock.call(['water', 'soil']), mock.call(['ice'])])
+
+
+class SearchPhraseTests(TestCase):
+
+    def setUp(self):
+        # 'ice' is a state, defined by the nouns 'frozen' and 'water'
+        self.ice = FakeSynset('ice')
+        self.svo = mock.Mock()
+        self.svo.matching_indices.side_effect = \
+            lambda term, cat: [0] if term == 'ice' else []
+        self.classes = mock.Mock(side_effect = \
+            lambda terms: {t:('Phenomenon',) if t == 'water' else () for t in terms})
+        self.variables = mock.Mock(side_effect = \
+            lambda terms: {t:((t+'_mass', t+' mass'),) for t in terms})
+        for patcher in [mock.patch.object(views, 'svo', self.svo),
+                        mock.patch.object(views.oc, 'synsets', lambda term: (self.ice,)),
+                        mock.patch.object(views, 'extract_nouns', lambda d: ('frozen', 'water')),
+                        mock.patch.object(views, 'search_ontology_for_class_batch', self.classes),
+                        mock.patch.object(views, 'search_ontology_vars_periph_batch', self.variables)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_search_keeps_phrase_order(self):
+        frozen = {'term':'frozen', 'classes':(), 'variables':(('frozen_mass', 'frozen mass'),)}
+        water = {'term':'water', 'classes':('Phenomenon',), \
+                 'variables':(('water_mass', 'water mass'),)}
+        ice = {'term':'ice', 'classes':(), 'variables':(('ice_mass', 'ice mass'),)}
+        self.assertEqual(views.search_phrase('water_ice'), \
+                         [water, ice, {'term':'ice', 'expansions':[[frozen, water]]}])
+        self.classes.assert_any_call(['water', 'ice'])
+        self.classes.assert_any_call(['frozen', 'water'])
+
+    def test_memo_reuses_expansions(self):
+        memo = {}
+        planned = views.plan_phrase('ice_ice', 0, memo)
+        self.assertIs(planned[1]['expansions'], planned[3]['expansions'])
+        self.assertIs(memo[('ice', 0)], planned[1]['expansions'])
+        ice_lookups = [c for c in self.svo.matching_indices.call_args_list if c[0][0] == 'ice']
+        self.assertEqual(len(ice_lookups), 1)
+
+    def test_failed_lookup_is_retried(self):
+        self.classes.side_effect = [ConnectionError('reset by peer'), {'water':()}]
+        with mock.patch('builtins.print'):
+            resp = views.index(None, 'water')
+        self.assertEqual(self.classes.call_count, 2)
+        self.assertEqual([r['IRI'] for r in json.loads(resp.content)['results']], \
+                         ['water_mass'])
+
+    def test_lookups_are_bounded_by_max_workers(self):
+        active = [0, 0]
+        lock = threading.Lock()
+        def slow_lookup(terms):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return {t:() for t in terms}
+        self.classes.side_effect = slow_lookup
+        self.variables.side_effect = slow_lookup
+        threads = [threading.Thread(target=views.search_phrase, args=('water_soil',)) \
+                   for _ in range(4*views.MAX_WORKERS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(active[1], views.MAX_WORKERS)
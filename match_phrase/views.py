@@ -2,9 +2,18 @@ from django.shortcuts import render
 from django.http import HttpResponse
 import re
 import json
-from SPARQLWrapper import SPARQLWrapper
-from SPARQLWrapper import JSON as sqjson
-from nltk.corpus import wordnet
+import heapq
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+# orjson parses large SPARQL results much faster, but is optional
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import nltk
 from . import ontology_category as oc
 
@@ -13,122 +22,254 @@ from django.conf import settings
 
 svo = oc.init_svo()
 
-# look up term in ontology, return its class(es) if exact match found
-def search_ontology_for_class(term):
-    sparql = SPARQLWrapper("http://sparql.geoscienceontology.org")
-    sparql.setQuery("""
+# maximum number of concurrent ontology queries, shared by all requests; this
+# is also the size of the HTTP connection pool, so every query gets a
+# kept-alive connection
+MAX_WORKERS = 16
+
+# the ontology queries of all searches run on this executor; its tasks never
+# wait on other tasks, so it cannot deadlock however deep a search recurses
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# SPARQL endpoint of the Scientific Variables Ontology
+SPARQL_ENDPOINT = "http://sparql.geoscienceontology.org"
+
+# connect and read timeouts of an ontology query in seconds; the executor is
+# shared by all requests, so a hung connection must not hold a worker forever
+SPARQL_TIMEOUT = (5, 30)
+
+# maximum time in seconds that a search waits for the results of a lookup,
+# including the time spent queued behind the lookups of other requests
+SEARCH_TIMEOUT = 60
+
+# a single HTTP session is shared by all ontology queries, so connections to
+# the endpoint are kept alive and reused across queries and threads
+_session = requests.Session()
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
+# load the tokenizer and POS tagger once instead of on every call
+_tokenizer = nltk.tokenize.TreebankWordTokenizer()
+_tagger = nltk.tag.PerceptronTagger()
+
+# valid search phrases are letters and underscores only
+_VALID_INPUT = re.compile(r"^[A-Za-z_]*\Z")
+
+# Penn Treebank noun tags, used to extract nouns from definitions
+_NOUN_TAGS = frozenset({'NN','NNS','NNP','NNPS'})
+
+# tokenize a definition and extract its nouns; the same definitions come
+# up across requests, so the result is cached
+@lru_cache(maxsize=10000)
+def extract_nouns(definition):
+    #Quick and dirty way to parse a phrase and extract nouns
+    tokenized = _tokenizer.tokenize(definition)
+    return tuple(word for (word, pos) in _tagger.tag(tokenized) if pos in _NOUN_TAGS)
+
+# escape a term for use inside a double quoted SPARQL string literal
+def sparql_escape(term):
+    return term.replace('\\','\\\\').replace('"','\\"')
+
+# run a query against the ontology SPARQL endpoint, return the result bindings
+def query_ontology(query):
+    resp = _session.get(SPARQL_ENDPOINT, params={'query':query}, \
+                        headers={'Accept':'application/sparql-results+json'}, \
+                        timeout=SPARQL_TIMEOUT)
+    resp.raise_for_status()
+    return json_loads(resp.content)["results"]["bindings"]
+
+# maximum number of terms kept in each ontology lookup cache; the caches are
+# least recently used first, and shared by the lookups of all threads
+CACHE_SIZE = 10000
+_class_cache = OrderedDict()
+_variable_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# return the results of lookup for the given terms as a dict by term; results
+# are cached per term, and the terms missing from the cache are looked up
+# together in a single call of lookup
+def cached_lookup(cache, lookup, terms):
+    terms = list(dict.fromkeys(terms))
+    found = {}
+    with _cache_lock:
+        for term in terms:
+            if term in cache:
+                cache.move_to_end(term)
+                found[term] = cache[term]
+    missing = [term for term in terms if not term in found]
+    if missing:
+        new = lookup(missing)
+        with _cache_lock:
+            for term, result in new.items():
+                cache[term] = result
+                cache.move_to_end(term)
+            # evict the least recently used terms
+            while len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+        found.update(new)
+    return found
+
+# build the contents of a SPARQL VALUES block listing the given terms
+def sparql_values(terms):
+    return ' '.join('"{}"'.format(sparql_escape(term)) for term in terms)
+
+# look up terms in ontology in a single query, return the class(es) of each
+# term if exact match found
+def query_classes(terms):
+    results = query_ontology("""
                     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
                     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 
-                    SELECT ?entity ?class
-                    WHERE {{ ?entity a ?class .
+                    SELECT ?term ?entity ?class
+                    WHERE {{ VALUES ?term {{ {} }}
+                           ?entity a ?class .
                            ?entity rdfs:label ?label .
-                           FILTER regex(?label,"^{}$") .}}
-                    """.format(term))
-    sparql.setReturnFormat(sqjson)
-    results = sparql.query().convert()
+                           FILTER (str(?label) = ?term) .}}
+                    """.format(sparql_values(terms)))
 
-    data = []
-    for result in results["results"]["bindings"]:
+    data = {term:[] for term in terms}
+    for result in results:
         c = result["class"]["value"].split('#')[1]
-        if not c in data:
-            data.append(c)
+        classes = data.setdefault(result["term"]["value"], [])
+        if not c in classes:
+            classes.append(c)
 
-    return data
+    return {term:tuple(classes) for term, classes in data.items()}
 
-# look up peripheral term in ontology; at this point this is agnostic to how
-# the term is connected to the variable, but in the future it will be expanded
-# to weigh main components more heavily than context or reference components.
-def search_ontology_vars_periph(term):
-    sparql = SPARQLWrapper("http://sparql.geoscienceontology.org")
-    sparql.setQuery("""
+# look up peripheral terms in ontology in a single query; at this point this is
+# agnostic to how the term is connected to the variable, but in the future it
+# will be expanded to weigh main components more heavily than context or
+# reference components.
+def query_variables(terms):
+    results = query_ontology("""
                     PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
                     PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
                     PREFIX svu: <http://www.geoscienceontology.org/svo/svu#>
 
-                    SELECT ?variable ?label ?varlabel
-                    WHERE {{ ?variable a svu:Variable .
+                    SELECT ?term ?variable ?label ?varlabel
+                    WHERE {{ VALUES ?term {{ {} }}
+                           ?variable a svu:Variable .
                            ?variable rdfs:label ?varlabel .
                            ?variable svu:subLabel ?label .
-                           FILTER regex(?label,"^{}$") .}}
-                    """.format(term))
-    sparql.setReturnFormat(sqjson)
-    results = sparql.query().convert()
-
-    data = []
-    varlabels = []
-    for result in results["results"]["bindings"]:
+                           FILTER (str(?label) = ?term) .}}
+                    """.format(sparql_values(terms)))
+
+    data = {term:[] for term in terms}
+    varlabels = {term:[] for term in terms}
+    for result in results:
+        term = result["term"]["value"]
         c = result["variable"]["value"].split('#')[1]
         l = result["varlabel"]["value"]
-        if not c in varlabels:
-            data.append([c,l])
-            varlabels.append(c)
+        if not c in varlabels.setdefault(term, []):
+            data.setdefault(term, []).append((c,l))
+            varlabels[term].append(c)
 
-    return data
+    return {term:tuple(variables) for term, variables in data.items()}
 
-# search and return phrase concept classes and related variables
-def search_phrase(phrase, depth=0):
-    terms = []
-    #Quick and dirty way to parse a phrase and extract nouns
-    # should move this up as its in the recursion stack currently
-    is_noun = lambda pos: pos[:2] == 'NN'
-    # go through the search phrase term by term
-    for term in phrase.split('_'):
-        # get the classes of a term and the variables explicitly linked to that term
-        term_classes = search_ontology_for_class(term)
-        term_variables = search_ontology_vars_periph(term)
-        terms.append({'term':term,'classes':term_classes,'variables':term_variables})
+# look up terms in ontology, return a dict of the class(es) of each term;
+# results are cached, so the returned tuples are shared between callers
+def search_ontology_for_class_batch(terms):
+    return cached_lookup(_class_cache, query_classes, terms)
+
+# look up peripheral terms in ontology, return a dict of the variables of each
+# term; results are cached, so the returned tuples are shared between callers
+def search_ontology_vars_periph_batch(terms):
+    return cached_lookup(_variable_cache, query_variables, terms)
+
+# expand a term by its 'state' definitions; returns the planned searches (see
+# plan_phrase) for the nouns of each matching definition, or None if the term
+# is not a state
+def expand_state(term, depth, memo):
+    # here only 'state' definitions are expanded
+    # this will be applied to attribute and phenomenon definitions as well in the future
+    # grab synsets found that pertain to 'state'
+    state_indices = svo.matching_indices(term,'state')
+    if not state_indices:
+        return None
+    # grab all of the synsets for the term
+    term_ss = oc.synsets(term)
+    expansions = []
+    # loop through the matched state definitions
+    for d in state_indices:
+        # simple algorithm:
+        # 1. grab term definition from wordnet
+        # 2. tokenize and extract nouns from phrase
+        # 3. plan the search recursively on the nouns in the definition
+        # NOTE: need to rank & filter out nouns to speed up this process
+        nouns = extract_nouns(oc.synset_meta(term_ss[d])[1])
+        expansions.append(plan_phrase('_'.join(nouns), depth+1, memo))
+    return expansions
+
+# plan the search of a phrase: the ontology lookups of its terms are submitted
+# to the shared executor, and the state expansions are planned recursively
+# while the lookups run; the same terms come up in many definitions, so the
+# expansions of a term are shared through memo, keyed by term and depth
+def plan_phrase(phrase, depth, memo):
+    tokens = phrase.split('_')
+    # get the classes of the terms and the variables explicitly linked to
+    # them, each in a single query for all terms
+    term_classes = _executor.submit(search_ontology_for_class_batch, tokens)
+    term_variables = _executor.submit(search_ontology_vars_periph_batch, tokens)
 
+    # go through the search phrase term by term
+    planned = []
+    for term in tokens:
+        planned.append({'term':term,'classes':term_classes,'variables':term_variables})
         #only go two levels deep
         if depth<2:
-            # here only 'state' definitions are expanded
-            # this will be applied to attribute and phenomenon definitions as well in the future
-            is_state = svo.is_cat(term,'state',out='short')
-            if is_state:
-                # grab synsets found that pertain to 'state'
-                cat = svo.is_cat(term,'state')
-                cat = cat.loc[cat['state']=='yes']
-                # grab all of the synsets for the term
-                term_ss = wordnet.synsets(term)
-                syn_phrase_results = []
-                # loop through the matched state definitions
-                for d in cat['wordnet_ss_index'].tolist():
-                    # simple algorithm:
-                    # 1. grab term definition from wordnet
-                    # 2. tokenize and extract nouns from phrase
-                    # 3. call this search function recursively on the nouns in the definition
-                    # NOTE: need to rank & filter out nouns to speed up this process
-                    phrase = term_ss[int(d)].definition()
-                    tokenized = nltk.word_tokenize(phrase)
-                    nouns = [word for (word, pos) in nltk.pos_tag(tokenized) if is_noun(pos)]
-                    phrase = '_'.join(nouns)
-                    syn_phrase_results.append(search_phrase(phrase,depth+1))
-                terms.append({'term':term,'expansions':syn_phrase_results})
+            if (term, depth) not in memo:
+                memo[(term, depth)] = expand_state(term, depth, memo)
+            expansions = memo[(term, depth)]
+            if expansions is not None:
+                planned.append({'term':term,'expansions':expansions})
+    return planned
+
+# wait for the ontology lookups of a planned search and return its results;
+# a lookup that does not finish within SEARCH_TIMEOUT raises TimeoutError
+def collect_phrase(planned):
+    terms = []
+    for p in planned:
+        if 'expansions' in p:
+            terms.append({'term':p['term'], \
+                          'expansions':[collect_phrase(ex) for ex in p['expansions']]})
+        else:
+            classes = p['classes'].result(timeout=SEARCH_TIMEOUT)
+            variables = p['variables'].result(timeout=SEARCH_TIMEOUT)
+            terms.append({'term':p['term'],'classes':classes[p['term']], \
+                          'variables':variables[p['term']]})
     return terms
 
+# search and return phrase concept classes and related variables
+def search_phrase(phrase, depth=0):
+    return collect_phrase(plan_phrase(phrase, depth, {}))
+
+# helper function that walks the nested phrase results once and yields each
+# variable match as (IRI, label, weight, is phenomenon); matches found in
+# expansions are weighed down by the number of expansions and terms seen
+# currently depth is over-penalized; this penalty should be relaxed
+def weighted_matches(phrase_results, num_expansions = 1, num_terms = 1):
+    for p in phrase_results:
+        if 'variables' in p:
+            weight = 1/num_expansions/num_terms
+            is_phenomenon = 'Phenomenon' in p['classes']
+            for iri, label in p['variables']:
+                yield iri, label, weight, is_phenomenon
+        elif 'expansions' in p:
+            num_expansions += len(p['expansions'])
+            for ex in p['expansions']:
+                num_terms += len(ex)
+                yield from weighted_matches(ex, num_expansions, num_terms)
+
 # based on num_matches, determine ontological matches
 def rank_matches(phrase_results, max_results=5):
 
-    # helper recrusive function that assigns rank to matches
-    # currently depth is over-penalized; this penalty should be relaxed
-    def tokens(phrase_results, var = {}, num_expansions = 1, num_terms = 1):
-        for p in phrase_results:
-            if 'variables' in p.keys():
-                for v in p['variables']:
-                    if v[0] in var.keys():
-                        var[v[0]][0] += 1/num_expansions/num_terms
-                    else:
-                        var[v[0]] = [ 1/num_expansions/num_terms, 0, v[1]]
-                        if 'Phenomenon' in p['classes']:
-                            var[v[0]][1] = 1/num_expansions/num_terms
-            elif 'expansions' in p.keys():
-                num_expansions += len(p['expansions'])
-                for ex in p['expansions']:
-                    num_terms += len(ex)
-                    var = tokens(ex,var,num_expansions,num_terms)
-        return var
-
-    var = tokens(phrase_results[1])
+    # accumulate the weighted matches of each variable in a single pass
+    var = {}
+    for iri, label, weight, is_phenomenon in weighted_matches(phrase_results[1]):
+        if iri in var:
+            var[iri][0] += weight
+        else:
+            var[iri] = [weight, weight if is_phenomenon else 0, label]
+
     # calculate match rank - currently matched by fraction of terms matched
     # rationale: simpler veriables, which are parent variables to more granular/ specific variables
     # will have a better rank match
@@ -147,15 +288,13 @@ def rank_matches(phrase_results, max_results=5):
         temp *= 0.4+0.6*var[key][1]
         # store rank and variable match
         var[key] = [round(temp,3),var[key][2]]
-    # sort the results by match rank in descending order and return the top max_results results
-    sorted_results = sorted(var.items(), key=lambda kv: kv[1])
-    sorted_results = sorted_results[::-1]
-    results = [{"IRI":x[0],"label":x[1][1],"matchrank":x[1][0]} for x in sorted_results]
-    return results[0:max_results]
+    # return the top max_results results by match rank in descending order
+    top_results = heapq.nlargest(max_results, var.items(), key=lambda kv: kv[1])
+    return [{"IRI":x[0],"label":x[1][1],"matchrank":x[1][0]} for x in top_results]
 
 # Create your views here.
 def index(request, foo):
-    if re.match("^[A-Za-z_]*$", foo):
+    if _VALID_INPUT.match(foo):
         # sometimes connection is reset by peer; two attempts
         tries = 0
         while tries < 2:
@@ -41,7 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'match_phrase',
+    'match_phrase.apps.MatchPhraseConfig',
 ]
 
 MIDDLEWARE = [
@@ -119,6 +119,14 @@ USE_L10N = True
 USE_TZ = True
 
 
+# WordNet preloading
+# Read all of WordNet in a background thread when the app starts, so that
+# requests do not wait on disk reads. The thread is a daemon, so it does not
+# keep management commands from exiting; set to False to skip the disk reads.
+
+WORDNET_PRELOAD = True
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 